@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
-import json
 from pathlib import Path
 import re
 
 import click
+import orjson
 from pandas import DataFrame
 import pandas
 
@@ -12,7 +12,8 @@ from seqbench_helpers import fail
 from seqbench_helpers import require
 
 
-BIN_FILE_NAME_REGEX = re.compile(r'(.*)-step-(\d{5})(?:-([a-zA-Z]))?.bin')
+# Anchored so that Series.str.extract(), which searches rather than matches, only accepts whole file names.
+BIN_FILE_NAME_REGEX = re.compile(r'^(?P<contract>.*)-step-(?P<index>\d{5})(?:-(?P<step>[a-zA-Z]))?\.bin$')
 
 STEP_NAMES = {
     None: '',
@@ -50,15 +51,7 @@ STEP_NAMES = {
     'x': 'ExpressionSplitter',
 }
 
-
-def split_bin_file_name(file_name: str) -> dict:
-    match = re.match(BIN_FILE_NAME_REGEX, file_name)
-    assert match is not None
-    return {
-        'contract': match[1],
-        'index': int(match[2]),
-        'step': match[3],
-    }
+STEP_CODES = [step for step in STEP_NAMES if step is not None]
 
 
 @click.command()
@@ -67,77 +60,81 @@ def split_bin_file_name(file_name: str) -> dict:
 @click.argument('sequence_info_path', required=False, nargs=1)
 @click.option('--name-prefix', default='')
 @click.option('--output-dir', default='.')
+@click.option('--jsonl', is_flag=True, default=False)
 def main(
     optimization_info_path: str,
     execution_info_path: str,
     sequence_info_path: str | None,
     name_prefix: str,
     output_dir: str,
+    jsonl: bool,
 ):
-    optimization_info = json.loads(Path(optimization_info_path).read_text())
-    execution_info = json.loads(Path(execution_info_path).read_text())
+    optimization_info = orjson.loads(Path(optimization_info_path).read_bytes())
+    execution_info = orjson.loads(Path(execution_info_path).read_bytes())
     if sequence_info_path is not None:
-        sequence_info = json.loads(Path(sequence_info_path).read_text())
+        sequence_info = orjson.loads(Path(sequence_info_path).read_bytes())
         sequence_info = sequence_info[0]['steps']
 
-    optimization_table = DataFrame(optimization_info)
-    optimization_table.set_index(['index'], inplace=True)
+    optimization_table = DataFrame(optimization_info).set_index('index')
 
     execution_table = DataFrame(execution_info)
-    execution_table['index'] = [split_bin_file_name(file_name)['index'] for file_name in execution_table['file']]
-    execution_table.set_index(['index'], inplace=True)
+    bin_file_names = execution_table['file'].str.extract(BIN_FILE_NAME_REGEX)
+    assert bin_file_names['index'].notna().all()
+    execution_table = execution_table.set_index(bin_file_names['index'].astype(int))
 
     if sequence_info_path is not None:
         sequence_table = DataFrame(sequence_info)
         # Sequence info is aware of hard-coded steps while optimization and execution info are not. Drop them.
         sequence_table = sequence_table[sequence_table.hardcoded == False]
-        # The index may have become non-contiguous so reindex
-        sequence_table.set_index(['index'], inplace=True)
-        sequence_table.reset_index(inplace=True)
-        # Sequence info is also missing step 0, which represents the empty sequence.
-        sequence_table.index += 1
+        # The index may have become non-contiguous so reindex.
+        # Sequence info is also missing step 0, which represents the empty sequence, so start from 1.
+        sequence_table = sequence_table.set_axis(pandas.RangeIndex(1, len(sequence_table) + 1))
         # Make sure indexes are compatible now. Note that they may still not be identical. Steps that failed compilation with
         # StackTooDeep or reverted during execution will be missing from optimization and/or execution info.
         require((execution_table.index[1:].isin(sequence_table.index)).all(), "Step indexes in sequence info do not match execution info.")
 
-    step_table = DataFrame({
-        'step': STEP_NAMES.keys(),
-        'step_name': STEP_NAMES.values(),
-    })
-    step_table.set_index(['step'], inplace=True)
-
-    merged_table = pandas.merge(optimization_table, execution_table, on='index', how='outer')
+    # All tables are indexed by step index so they can be joined on the index directly
+    merged_table = optimization_table.join(execution_table, how='outer')
     if sequence_info_path is not None:
         require((
             (optimization_table['step'][1:] == sequence_table['step']) |
             optimization_table['step'][1:].isna()
         ).all(), "Steps in sequence info do not match optimization info.")
-        merged_table = pandas.merge(
-            merged_table,
+        merged_table = merged_table.join(
             # Step columns are identical except for index 0, where sequence_table is missing an item. Not dropping the column
-            # would result in two separate columns after merge (step_x and step_y).
+            # would result in a conflict between the two columns.
             sequence_table.drop(columns=['step']),
-            left_on='index',
-            right_index=True,
             how='outer',
         )
 
-    unknown_steps = set(merged_table['step'].unique()) - set(step_table.index) - {None}
+    unknown_steps = set(merged_table['step'].dropna().unique()) - set(STEP_CODES)
     require(len(unknown_steps) == 0, f"Unknown steps in the sequence: {unknown_steps}")
-    merged_table = pandas.merge(merged_table, step_table, left_on='step', right_index=True, how='inner').sort_index()
+    merged_table['step'] = pandas.Categorical(merged_table['step'], categories=STEP_CODES)
+    merged_table['step_name'] = merged_table['step'].map(STEP_NAMES).astype('object').fillna(STEP_NAMES[None])
 
     selected_columns = ['step', 'step_name', 'bytecode_size', 'creation_gas', 'runtime_gas', 'compilation_time']
     if sequence_info_path is not None:
         selected_columns += ['duration_microsec', 'optimization_time']
         # Replace empty values with 0 because they force column type to float.
         # There should be only one empty value anyway (at index 0, i.e. before the first step)
-        merged_table['duration_microsec'].fillna(0, inplace=True)
+        merged_table['duration_microsec'] = merged_table['duration_microsec'].fillna(0)
         merged_table['optimization_time'] = merged_table['duration_microsec'].cumsum()
 
     pretty_table = merged_table[selected_columns]
 
     Path(output_dir).mkdir(parents=True, exist_ok=True)
-    pretty_table.to_json(Path(output_dir) / f'{name_prefix}report.json', orient='columns', indent=4)
+    if jsonl:
+        # One object per step, with the index stored in the 'index' field. Can be read in chunks.
+        (Path(output_dir) / f'{name_prefix}report.jsonl').write_bytes(b''.join(
+            orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_SERIALIZE_NUMPY)
+            for row in pretty_table.reset_index().to_dict(orient='records')
+        ))
+    else:
+        # Same structure as DataFrame.to_json(orient='columns'), i.e. {column: {index: value}}. NaN is serialized as null.
+        (Path(output_dir) / f'{name_prefix}report.json').write_bytes(orjson.dumps(
+            pretty_table.to_dict(orient='dict'),
+            option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY,
+        ))
 
 
 if __name__ == '__main__':
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
 import json
 from pathlib import Path
+from queue import Queue
 import subprocess
 import sys
 
@@ -12,22 +15,21 @@ from seqbench_helpers import fail
 from seqbench_helpers import require
 
 
-def deploy_contract(bytecode: str, private_key: str) -> dict:
-    return json.loads(subprocess.check_output([
+def cast_send_command(private_key: str) -> list[str]:
+    # NOTE: cast does not read the raw private key from the environment so it has to be passed in argv.
+    return [
         'cast', 'send',
         '--json',
         '--private-key', private_key,
-        '--create', bytecode,
-    ]).decode('utf-8'))
+    ]
 
 
-def call_contract(address: str, call_signature_and_arguments: list[str], private_key: str) -> dict | str:
-    command = [
-        'cast', 'send',
-        '--json',
-        '--private-key', private_key,
-        address,
-    ] + call_signature_and_arguments
+def deploy_contract(bytecode: str, send_command: list[str]) -> dict:
+    return json.loads(subprocess.check_output(send_command + ['--create', bytecode]).decode('utf-8'))
+
+
+def call_contract(address: str, call_signature_and_arguments: list[str], send_command: list[str]) -> dict | str:
+    command = send_command + [address] + call_signature_and_arguments
 
     try:
         output = subprocess.check_output(command, stderr=subprocess.PIPE)
@@ -45,74 +47,102 @@ def call_contract(address: str, call_signature_and_arguments: list[str], private
 
 def load_calls(call_definition_file: Path) -> list[list[str]]:
     calls = []
-    for line in call_definition_file.read_text().split('\n'):
+    for line in call_definition_file.read_text().splitlines():
         # Remove comments
-        clean_line = line.split('#', 1)[0]
-        if clean_line == '':
+        (clean_line, _, _) = line.partition('#')
+        arguments = clean_line.split()
+        if len(arguments) == 0:
             continue
 
-        calls.append([])
-        for argument in clean_line.split(' '):
-            if argument == '':
-                continue
-
-            clean_argument = argument.strip()
+        for argument in arguments:
             require(
                 # Don't allow arguments that could be interpreted as cast options other than --value.
-                not clean_argument.startswith('-') or clean_argument == '--value',
-                f"Arguments not allowed in the call (found {clean_argument} in {line})."
+                not argument.startswith('-') or argument == '--value',
+                f"Arguments not allowed in the call (found {argument} in {line})."
             )
-            calls[-1].append(clean_argument)
+        calls.append(arguments)
 
     return calls
 
 
-def execute_all_steps(bin_dir: Path, call_definition_file: Path, output_dir: Path, private_key: str):
+def execute_step(bin_file: Path, calls: list[list[str]], output_file: Path, send_command: list[str]):
+    print(f"Writing {output_file}")
+
+    # TODO: Deploying once per contract and executing all its sigs in one cycle would be more efficient
+    bytecode = bin_file.read_text().strip()
+    require(len(bytecode) % 2 == 0, "Invalid bytecode: odd number of hexadecimal digits.")
+    require(not bytecode.startswith('0x'), "Expected hex-encoded bytecode, without 0x prefix.")
+    creation_info = deploy_contract(bytecode, send_command)
+
+    # NOTE: Transactions from other workers may end up in the same block so cumulativeGasUsed is not reliable.
+    runtime_gas = 0
+    execution_status = 'success'
+    for call in calls:
+        print(f"Executing call: {' '.join(call)}")
+        runtime_info = call_contract(creation_info['contractAddress'], call, send_command)
+        if isinstance(runtime_info, str):
+            runtime_gas = None
+            execution_status = runtime_info
+            break
+        else:
+            runtime_gas += int(runtime_info['gasUsed'], base=16)
+            execution_status = 'success'
+
+    output = json.dumps({
+        'file': bin_file.name,
+        'bytecode_size': len(bytecode) // 2,
+        'creation_gas': int(creation_info['gasUsed'], base=16),
+        'runtime_gas': runtime_gas,
+        'execution_status': execution_status,
+    }, indent=4)
+    print(output)
+    output_file.write_text(output)
+
+
+def execute_all_steps(bin_dir: Path, call_definition_file: Path, output_dir: Path, private_keys: list[str]):
     calls = load_calls(call_definition_file)
 
     output_dir.mkdir(parents=True, exist_ok=True)
-    for dir_item in sorted(bin_dir.iterdir()):
-        if not dir_item.is_dir() and dir_item.suffix == '.bin':
-            output_file = (output_dir / (dir_item.stem + '.json'))
-            print(f"Writing {output_file}")
-
-            # TODO: Deploying once per contract and executing all its sigs in one cycle would be more efficient
-            bytecode = dir_item.read_text().strip()
-            require(len(bytecode) % 2 == 0, "Invalid bytecode: odd number of hexadecimal digits.")
-            require(not bytecode.startswith('0x'), "Expected hex-encoded bytecode, without 0x prefix.")
-            creation_info = deploy_contract(bytecode, private_key)
-
-            runtime_gas = 0
-            execution_status = 'success'
-            for call in calls:
-                print(f"Executing call: {' '.join(call)}")
-                runtime_info = call_contract(creation_info['contractAddress'], call, private_key)
-                if isinstance(runtime_info, str):
-                    runtime_gas = None
-                    execution_status = runtime_info
-                    break
-                else:
-                    runtime_gas += int(runtime_info['cumulativeGasUsed'], base=16)
-                    execution_status = 'success'
-
-            output = json.dumps({
-                'file': dir_item.name,
-                'bytecode_size': len(bytecode) // 2,
-                'creation_gas': int(creation_info['cumulativeGasUsed'], base=16),
-                'runtime_gas': runtime_gas,
-                'execution_status': execution_status,
-            }, indent=4)
-            print(output)
-            output_file.write_text(output)
+    bin_files = [
+        dir_item
+        for dir_item in sorted(bin_dir.iterdir())
+        if not dir_item.is_dir() and dir_item.suffix == '.bin'
+    ]
+
+    # Each account has its own nonce so transactions sent from different accounts do not conflict.
+    # Steps are independent and can be executed in parallel as long as each worker holds a separate key.
+    # The command prefix for each key is constructed only once and reused for all transactions.
+    available_send_commands = Queue()
+    for private_key in private_keys:
+        available_send_commands.put(cast_send_command(private_key))
+
+    def execute_step_with_free_key(bin_file: Path):
+        send_command = available_send_commands.get()
+        try:
+            execute_step(bin_file, calls, output_dir / (bin_file.stem + '.json'), send_command)
+        finally:
+            available_send_commands.put(send_command)
+
+    with ThreadPoolExecutor(max_workers=len(private_keys)) as executor:
+        futures = [executor.submit(execute_step_with_free_key, bin_file) for bin_file in bin_files]
+        try:
+            # Consume the results to make sure exceptions raised by workers get propagated.
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            # Stop on the first failure, like sequential execution would. Don't run steps that did not start yet.
+            executor.shutdown(cancel_futures=True)
+            raise
 
 
 @click.command()
 @click.argument('bin_dir', nargs=1)
 @click.argument('call_definition_file', nargs=1)
 @click.option('--output-dir', default='.')
-@click.option('--private-key', required=True)
-def main(bin_dir: str, call_definition_file: str, output_dir: str, private_key: str):
-    execute_all_steps(Path(bin_dir), Path(call_definition_file), Path(output_dir), private_key)
+@click.option('--private-key', required=True, multiple=True)
+def main(bin_dir: str, call_definition_file: str, output_dir: str, private_key: tuple[str]):
+    require(len(private_key) == len(set(private_key)), "Private keys must be unique.")
+    execute_all_steps(Path(bin_dir), Path(call_definition_file), Path(output_dir), list(private_key))
 
 
 if __name__ == '__main__':
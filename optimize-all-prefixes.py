@@ -1,19 +1,25 @@
 #!/usr/bin/env python3
 
-import json
+from collections import deque
+from concurrent.futures import Executor
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import blake2b
+import os
 from pathlib import Path
-from resource import getrusage, RUSAGE_CHILDREN
+import shutil
 import subprocess
+from typing import Generator
 
 import click
+import orjson
 
 import seqbench_helpers
 from seqbench_helpers import fail
 from seqbench_helpers import require
 
 
-def extract_artifacts(json_output: str) -> (str, str, dict):
-    output = json.loads(json_output)
+def extract_artifacts(json_output: bytes) -> (str, str, dict):
+    output = orjson.loads(json_output)
 
     if 'errors' in output:
         if (
@@ -28,53 +34,109 @@ def extract_artifacts(json_output: str) -> (str, str, dict):
         if len(actual_errors) > 0:
             fail("\n    ".join(["Compilation failed."] + actual_errors))
 
-    source_names = list(output['contracts'].keys())
-    contract_names = list(output['contracts'][source_names[0]].keys())
-    require(len(source_names) == 1 and len(contract_names) == 1, "More than one file or contract found in Standard JSON output.")
+    # NOTE: outputSelection already limits the output to the artifacts used below so there's nothing to skip
+    # when parsing. The only other top-level key present is 'sources', which is tiny.
+    require(len(output['contracts']) == 1, "More than one file or contract found in Standard JSON output.")
+    [source_contracts] = output['contracts'].values()
+    require(len(source_contracts) == 1, "More than one file or contract found in Standard JSON output.")
+    [contract] = source_contracts.values()
 
-    bytecode         = output['contracts'][source_names[0]][contract_names[0]]['evm']['bytecode']['object']
-    ir_optimized     = output['contracts'][source_names[0]][contract_names[0]]['irOptimized']
+    bytecode         = contract['evm']['bytecode']['object']
+    ir_optimized     = contract['irOptimized']
     compilation_info = {'status': 'success'}
 
     return (bytecode, ir_optimized, compilation_info)
 
 
-def execute_command_timed(command, standard_input) -> (str, int):
-    usage_before = getrusage(RUSAGE_CHILDREN)
-    output = subprocess.check_output(
-        ['solc', '--standard-json', '-', '--pretty-json', '--json-indent=4'],
-        input=standard_input,
-    )
-    usage_after = getrusage(RUSAGE_CHILDREN)
+def execute_command_timed(command, standard_input: bytes) -> (bytes, float):
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=-1)
+
+    # solc reads the whole input before producing any output so writing it all up front cannot deadlock.
+    try:
+        with process.stdin:
+            process.stdin.write(standard_input)
+    except BrokenPipeError:
+        # The process exited without reading the input. Its exit code will tell what happened.
+        pass
+    with process.stdout:
+        output = process.stdout.read()
+
+    # Reap the process ourselves to get the resource usage of this particular child. Unlike RUSAGE_CHILDREN
+    # this is not affected by other commands running at the same time.
+    (_, wait_status, usage) = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(wait_status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command, output)
 
     # NOTE: ru_time is a floating-point value
-    user_mode_cpu_time_in_seconds = usage_after.ru_utime - usage_before.ru_utime
-    return (output.decode('utf-8'), user_mode_cpu_time_in_seconds)
+    return (output, usage.ru_utime)
 
 
-def optimize_yul(yul_file: Path, optimizer_steps: str, solc_binary: Path) -> (str, str, dict):
+def optimize_yul(yul_file: Path, yul_source: str, optimizer_steps: str, solc_binary: Path) -> (str, str, dict):
     json_input: dict = {
         'language': 'Yul',
         'sources': {
-            str(yul_file): {'urls': [str(yul_file)]}
+            # Pass the source inline so that solc does not have to read the file again for every prefix
+            str(yul_file): {'content': yul_source}
         },
         'settings': {
             'optimizer': {
                 'enabled': True,
                 'details': {'yulDetails': {'optimizerSteps': optimizer_steps}},
             },
+            # NOTE: Always request the same outputs. Generating IR takes time, which would otherwise be included
+            # in compilation_time only for some of the prefixes.
             'outputSelection': {'*': {'*': ['evm.bytecode.object', 'irOptimized']}},
         }
     }
 
     (output, cpu_time) = execute_command_timed(
-        [str(solc_binary), '--standard-json', '-', '--pretty-json', '--json-indent=4'],
-        json.dumps(json_input).encode('utf-8'),
+        [str(solc_binary), '--standard-json', '-'],
+        orjson.dumps(json_input),
     )
     (bytecode, ir_optimized, compilation_info) = extract_artifacts(output)
     return (bytecode, ir_optimized, compilation_info | {'compilation_time': cpu_time})
 
 
+def compilation_input_digest(yul_source: str, solc_binary: Path) -> str:
+    solc_path = shutil.which(str(solc_binary))
+    require(solc_path is not None, f"solc binary not found: {solc_binary}.")
+
+    digest = blake2b(digest_size=16)
+    digest.update(Path(solc_path).read_bytes())
+    digest.update(yul_source.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def optimize_yul_cached(
+    yul_file: Path,
+    yul_source: str,
+    optimizer_steps: str,
+    solc_binary: Path,
+    cache_dir: Path | None,
+    input_digest: str | None,
+) -> (str, str, dict):
+    if cache_dir is None:
+        return optimize_yul(yul_file, yul_source, optimizer_steps, solc_binary)
+
+    # The key covers everything that affects the output: the compiler binary, the input and the sequence.
+    cache_key = blake2b(f'{input_digest}:{optimizer_steps}'.encode('utf-8'), digest_size=16).hexdigest()
+    cache_file = cache_dir / f'{cache_key}.json'
+    if cache_file.exists():
+        # NOTE: compilation_time comes from the run that created the entry. Mark the result so that it's clear
+        # that it was not measured again.
+        (bytecode, ir_optimized, compilation_info) = orjson.loads(cache_file.read_bytes())
+        return (bytecode, ir_optimized, compilation_info | {'cached': True})
+
+    artifacts = optimize_yul(yul_file, yul_source, optimizer_steps, solc_binary)
+
+    # Write under a temporary name and rename to avoid leaving a truncated entry behind if interrupted.
+    temporary_file = cache_dir / f'{cache_key}.{os.getpid()}.tmp'
+    temporary_file.write_bytes(orjson.dumps(artifacts))
+    temporary_file.replace(cache_file)
+    return artifacts
+
+
 def validate_sequence(optimizer_steps: str):
     depth = 0
     for i, step in enumerate(optimizer_steps):
@@ -102,15 +164,15 @@ def validate_sequence(optimizer_steps: str):
     require(depth == 0, f"Found unmatched ']' in the sequence")
 
 
-def iterative_yul_optimizer(yul_file: Path, optimizer_steps: str, solc_binary: Path):
+def prefix_schedule(optimizer_steps: str, initial_ir: str | None) -> Generator[list[str], str | None, None]:
+    # Yields batches of prefixes to compile. Prefixes within a batch do not depend on each other.
+    # The IR produced by the last prefix in the batch must be sent back before the next batch is requested
+    # because it decides whether fixed-point loops repeat.
     MAX_ITERATIONS = 12
     position = 0
     prefix = ''
     stack = []
-
-    (bytecode, ir, compilation_info) = optimize_yul(yul_file, prefix + ':', solc_binary)
-    require(compilation_info['status'] == 'success', "Unoptimized compilation failed.")
-    yield (prefix, bytecode, ir, compilation_info)
+    ir = initial_ir
 
     while position < len(optimizer_steps):
         step = optimizer_steps[position]
@@ -136,39 +198,138 @@ def iterative_yul_optimizer(yul_file: Path, optimizer_steps: str, solc_binary: P
         elif step == ':':
             position += 1
         else:
-            # Assume anything else is a step and just let the compiler fail if it's not.
-            assert step != ':'
+            # Only brackets need the result of the previous compilation. Prefixes ending at steps before the
+            # next bracket are independent.
+            batch_prefixes = []
+            while position < len(optimizer_steps) and optimizer_steps[position] not in '[]':
+                step = optimizer_steps[position]
+                if not str.isspace(step) and step != ':':
+                    # Assume anything else is a step and just let the compiler fail if it's not.
+                    prefix += step
+                    batch_prefixes.append(prefix)
+                position += 1
+
+            ir = yield batch_prefixes
 
-            prefix += step
-            position += 1
+    assert len(stack) == 0
 
-            (bytecode, ir, compilation_info) = optimize_yul(yul_file, prefix + ':' if ':' not in prefix else prefix, solc_binary)
-            yield (prefix, bytecode, ir, compilation_info)
 
-    assert len(stack) == 0
+def iterative_yul_optimizer(
+    yul_file: Path,
+    optimizer_steps: str,
+    solc_binary: Path,
+    executor: Executor,
+    jobs: int,
+    cache_dir: Path | None,
+    skip_after_stack_too_deep: bool,
+):
+    yul_source = yul_file.read_text()
+    input_digest = compilation_input_digest(yul_source, solc_binary) if cache_dir is not None else None
 
+    (bytecode, ir, compilation_info) = optimize_yul_cached(yul_file, yul_source, ':', solc_binary, cache_dir, input_digest)
+    require(compilation_info['status'] == 'success', "Unoptimized compilation failed.")
+    yield ('', bytecode, ir, compilation_info)
+
+    schedule = prefix_schedule(optimizer_steps, ir)
+    batch_prefixes = next(schedule, None)
+    while batch_prefixes is not None:
+        # Keep only a limited number of compilations in flight. Submitting the whole batch at once would keep the
+        # results of all of them (which include IR, often several MB) in memory until the whole batch is consumed.
+        max_pending_futures = 2 * jobs
+        pending_futures = deque()
+        hit_stack_too_deep = False
+        for i, prefix in enumerate(batch_prefixes):
+            if hit_stack_too_deep and i < len(batch_prefixes) - 1:
+                # Assume that the rest of the batch fails as well. Drop all later prefixes, including the ones that
+                # were already compiled, so that the result does not depend on how far the workers got.
+                # The last prefix is the exception. Its IR decides whether a fixed-point loop repeats so it always
+                # gets compiled.
+                # NOTE: This is only an approximation. Later steps may reduce stack pressure enough to make
+                # the code compile again and those results will be missing.
+                (bytecode, ir, compilation_info) = (None, None, {'status': 'stack-too-deep', 'skipped': True})
+            else:
+                while len(pending_futures) < max_pending_futures and i + len(pending_futures) < len(batch_prefixes):
+                    next_prefix = batch_prefixes[i + len(pending_futures)]
+                    pending_futures.append(executor.submit(
+                        optimize_yul_cached,
+                        yul_file,
+                        yul_source,
+                        next_prefix + ':',
+                        solc_binary,
+                        cache_dir,
+                        input_digest,
+                    ))
+
+                (bytecode, ir, compilation_info) = pending_futures.popleft().result()
+                if skip_after_stack_too_deep and compilation_info['status'] == 'stack-too-deep':
+                    hit_stack_too_deep = True
+                    for pending_future in pending_futures:
+                        pending_future.cancel()
+                    pending_futures.clear()
+            yield (prefix, bytecode, ir, compilation_info)
 
-def optimize_yul_with_intermediate_snapshots(yul_file: Path, optimizer_steps: str, output_dir: Path, solc_binary: Path):
+        try:
+            batch_prefixes = schedule.send(ir)
+        except StopIteration:
+            batch_prefixes = None
+
+
+def optimize_yul_with_intermediate_snapshots(
+    yul_file: Path,
+    optimizer_steps: str,
+    output_dir: Path,
+    solc_binary: Path,
+    jobs: int,
+    cache_dir: Path | None,
+    save_ir: bool,
+    skip_after_stack_too_deep: bool,
+):
     output_dir.mkdir(parents=True, exist_ok=True)
-    for i, (prefix, bytecode, ir_optimized, compilation_info) in enumerate(iterative_yul_optimizer(Path(yul_file), optimizer_steps, solc_binary)):
-        file_basename = f'{yul_file.stem}-step-{i:05d}'
-        if len(prefix) > 0:
-            file_basename += f'-{prefix[-1]}'
-        print(prefix, end='')
-
-        if bytecode is not None:
-            (output_dir / f'{file_basename}.yul').write_text(ir_optimized)
-        if ir_optimized is not None:
-            (output_dir / f'{file_basename}.bin').write_text(bytecode)
-
-        assert compilation_info is not None
-        extra_info = {
-            'prefix': prefix,
-            'step': prefix[-1] if len(prefix) > 0 else None,
-            'index': i,
-        }
-        (output_dir / f'{file_basename}.json').write_text(json.dumps(compilation_info | extra_info, indent=4))
-        print(f" | {compilation_info['status']}")
+    if cache_dir is not None:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+
+    # Paths of all snapshot files share the same prefix. Build it once rather than joining paths for every file.
+    snapshot_path_prefix = os.path.join(output_dir, f'{yul_file.stem}-step-')
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        snapshots = iterative_yul_optimizer(
+            Path(yul_file),
+            optimizer_steps,
+            solc_binary,
+            executor,
+            jobs,
+            cache_dir,
+            skip_after_stack_too_deep,
+        )
+        try:
+            for i, (prefix, bytecode, ir_optimized, compilation_info) in enumerate(snapshots):
+                snapshot_path = f'{snapshot_path_prefix}{i:05d}'
+                if len(prefix) > 0:
+                    snapshot_path += f'-{prefix[-1]}'
+                print(prefix, end='')
+
+                # IR is much larger than bytecode and not needed by later stages so it's only saved on request.
+                if save_ir and ir_optimized is not None:
+                    with open(f'{snapshot_path}.yul', 'w') as ir_file:
+                        ir_file.write(ir_optimized)
+                if bytecode is not None:
+                    with open(f'{snapshot_path}.bin', 'w') as bin_file:
+                        bin_file.write(bytecode)
+
+                assert compilation_info is not None
+                extra_info = {
+                    'prefix': prefix,
+                    'step': prefix[-1] if len(prefix) > 0 else None,
+                    'index': i,
+                }
+                with open(f'{snapshot_path}.json', 'wb') as json_file:
+                    json_file.write(orjson.dumps(compilation_info | extra_info, option=orjson.OPT_INDENT_2))
+                print(f" | {compilation_info['status']}")
+        except BaseException:
+            # Stop on the first failure, like sequential compilation would. Don't compile prefixes that did not
+            # start yet.
+            executor.shutdown(cancel_futures=True)
+            raise
 
 
 @click.command()
@@ -176,10 +337,35 @@ def optimize_yul_with_intermediate_snapshots(yul_file: Path, optimizer_steps: st
 @click.argument('optimizer_steps', nargs=1)
 @click.option('--output-dir', default='.')
 @click.option('--solc-binary', default='solc')
-def main(yul_file: str, optimizer_steps: str, output_dir: str, solc_binary: str):
+# NOTE: Compilations running in parallel compete for cores and caches, which inflates compilation_time.
+# Use more than one job only when timings do not matter.
+@click.option('--jobs', type=int, default=1)
+@click.option('--cache-dir', default=None)
+@click.option('--save-ir/--no-save-ir', default=False)
+@click.option('--skip-after-stack-too-deep', is_flag=True, default=False)
+def main(
+    yul_file: str,
+    optimizer_steps: str,
+    output_dir: str,
+    solc_binary: str,
+    jobs: int,
+    cache_dir: str | None,
+    save_ir: bool,
+    skip_after_stack_too_deep: bool,
+):
     require(Path(yul_file).suffix == '.yul', "Input file must have the .yul extension.")
+    require(jobs >= 1, "The number of jobs must be at least 1.")
     validate_sequence(optimizer_steps)
-    optimize_yul_with_intermediate_snapshots(Path(yul_file), optimizer_steps, Path(output_dir), Path(solc_binary))
+    optimize_yul_with_intermediate_snapshots(
+        Path(yul_file),
+        optimizer_steps,
+        Path(output_dir),
+        Path(solc_binary),
+        jobs,
+        Path(cache_dir) if cache_dir is not None else None,
+        save_ir,
+        skip_after_stack_too_deep,
+    )
 
 
 if __name__ == '__main__':
@@ -22,3 +22,21 @@ def format_percent(decimal_value: int | float, fractional_digits: int = 0):
         ''
     )
     return f'{prefix}{round(percentage, fractional_digits)}%'
+
+
+def format_percent_series(decimal_values, fractional_digits: int = 0):
+    # Same as format_percent() but applied to a whole pandas Series at once.
+    percentages = decimal_values.astype(float) * 100
+    # NOTE: Series.round() does not give the same results as round() for values close to a half (it scales the
+    # value before rounding it) so only the prefix logic is vectorized.
+    rounded = percentages.map(lambda percentage: round(percentage, fractional_digits))
+    zero_after_rounding = (rounded == 0)
+
+    # Missing values stay NaN through the concatenation below and end up as empty strings
+    prefixes = (
+        rounded.mask(rounded.notna(), '')
+        # Distinguish actual zero from very small differences
+        .mask(zero_after_rounding & (percentages > 0), '+')
+        .mask(zero_after_rounding & (percentages < 0), '-')
+    )
+    return (prefixes + rounded.astype(str) + '%').fillna('')
@@ -0,0 +1,34 @@
+import numpy
+import pandas
+
+from seqbench_helpers import format_percent
+from seqbench_helpers import format_percent_series
+
+
+def test_format_percent_series_matches_format_percent_on_halves():
+    # Ratios of gas values that land exactly on a half after scaling to percent, for 0, 1 and 2 fractional digits
+    # (e.g. 2000 -> 2021 is +1.05%, 2000 -> 1999 is -0.05%) plus a few special values.
+    decimal_values = (
+        [(new - 2000) / 2000 for new in range(1900, 2100)] +
+        [k / 200 + 1 / 400 for k in range(-200, 200)] +
+        [0.0, -0.0, 1e-9, -1e-9, numpy.inf, -numpy.inf]
+    )
+
+    for fractional_digits in [0, 1, 2]:
+        expected = [format_percent(value, fractional_digits=fractional_digits) for value in decimal_values]
+        actual = format_percent_series(pandas.Series(decimal_values), fractional_digits=fractional_digits)
+        assert actual.tolist() == expected
+
+
+def test_format_percent_series_missing_values():
+    assert format_percent_series(pandas.Series([numpy.nan, 0.5, None])).tolist() == ['', '50.0%', '']
+
+
+def test_format_percent_series_per_column_matches_format_percent_per_cell():
+    # visualize-output.py formats diff tables by applying format_percent_series() to each column
+    ratios = pandas.DataFrame({
+        'runtime_gas': [(2021 - 2000) / 2000, numpy.nan, (1999 - 2000) / 2000],
+        'bytecode_size': [-1e-9, 0.0, (1 - 3) / 3],
+    })
+    expected = ratios.astype(object).where(ratios.notna(), None).map(lambda x: format_percent(x, fractional_digits=1))
+    assert ratios.apply(format_percent_series, fractional_digits=1).equals(expected)
@@ -1,116 +1,246 @@
 #!/usr/bin/env python3
 
-import json
+import io
+import mmap
 from pathlib import Path
 
 import click
-import matplotlib.pyplot as plt
 import numpy
+import orjson
 from pandas import DataFrame
+from pandas import Series
 import pandas
-from tabulate import tabulate
 
 import seqbench_helpers
 from seqbench_helpers import fail
-from seqbench_helpers import format_percent
+from seqbench_helpers import format_percent_series
 from seqbench_helpers import require
 
 
-def plot_column_with_step_labels(table: DataFrame, column_name: str, ylabel: str, title: str, style: str = 'line', origin_at_zero: bool = True):
+# Above this number of steps labels just overlap into an unreadable blob unless the plot can be zoomed in.
+# In SVG output each of them is also a separate group of glyphs, which makes the files large and slow to render.
+STEP_LABEL_LIMIT = 500
+
+
+# Types of the columns that analyze-output.py may put in a report. Numeric columns may have missing values.
+REPORT_COLUMN_DTYPES = {
+    'index': 'int64',
+    'step': 'object',
+    'step_name': 'object',
+    'bytecode_size': 'float64',
+    'creation_gas': 'float64',
+    'runtime_gas': 'float64',
+    'compilation_time': 'float64',
+    'duration_microsec': 'float64',
+    'optimization_time': 'float64',
+}
+
+
+def add_step_labels(axes, x_values: numpy.ndarray, y_values: numpy.ndarray, steps: numpy.ndarray):
+    # Plain text artists sharing a single offset transform are much cheaper to create and draw than
+    # a separate annotation per step.
+    from matplotlib.transforms import offset_copy
+    label_transform = offset_copy(axes.transData, fig=axes.figure, y=5, units='points')
+    for x, y, step in zip(x_values, y_values, steps):
+        # NOTE: Unlike annotations, text is not hidden by default when its point is outside of the axes.
+        # Clip it so that labels of points out of view do not get drawn over the margins when zoomed in.
+        axes.text(x, y, step, transform=label_transform, size=7, clip_on=True)
+
+
+def plot_column_with_step_labels(
+    indices: numpy.ndarray,
+    steps: numpy.ndarray,
+    values: numpy.ndarray,
+    ylabel: str,
+    title: str,
+    style: str = 'line',
+    origin_at_zero: bool = True,
+    step_labels: bool = True,
+):
     assert style in {'line', 'bar'}
+    assert len(indices) == len(steps) == len(values)
 
+    series = Series(values, index=indices, copy=False)
     if style == 'bar':
-        axes = table[column_name].plot.bar(title=title, xlabel='step', ylabel=ylabel, figsize=(25, 15))
+        axes = series.plot.bar(title=title, xlabel='step', ylabel=ylabel, figsize=(25, 15))
         axes.grid(axis='y')
-        plt.tick_params(bottom=False, labelbottom=False)
+        axes.tick_params(bottom=False, labelbottom=False)
     else:
-        axes = table[column_name].plot(title=title, xlabel='step', ylabel=ylabel, figsize=(25, 15), grid=True)
+        axes = series.plot(title=title, xlabel='step', ylabel=ylabel, figsize=(25, 15), grid=True)
         axes.ticklabel_format(useOffset=False, style='plain')
     if origin_at_zero:
         axes.set_ylim(bottom=0)
         axes.set_xlim(left=0)
-    for index, step, value in zip(table.index, table['step'], table[column_name]):
-        axes.annotate(step, (index, value), xytext=(0, 5), textcoords='offset points', size=7)
+    if step_labels:
+        add_step_labels(axes, indices, values, steps)
+
+
+def plot_xy_with_step_labels(
+    x_values: numpy.ndarray,
+    y_values: numpy.ndarray,
+    steps: numpy.ndarray,
+    xlabel: str,
+    ylabel: str,
+    title: str,
+    start_index: int = 0,
+    origin_at_zero: bool = True,
+    step_labels: bool = True,
+):
+    assert len(x_values) == len(y_values) == len(steps)
 
+    import matplotlib.pyplot as plt
 
-def plot_xy_with_step_labels(table: DataFrame, x_column: str, y_column: str, xlabel: str, ylabel: str, title: str, start_index: int = 0, origin_at_zero: bool = True):
-    x_values = table[x_column][start_index:]
-    y_values = table[[y_column]][start_index:].set_index(x_values)
-    axes = y_values.plot(title=title, xlabel=xlabel, ylabel=ylabel, figsize=(25, 15), grid=True, ax=plt.gca())
+    x_values = x_values[start_index:]
+    y_values = y_values[start_index:]
+    axes = plt.gca()
+    axes.figure.set_size_inches((25, 15))
+    axes.plot(x_values, y_values)
+    axes.set(title=title, xlabel=xlabel, ylabel=ylabel)
+    axes.grid(True)
     axes.ticklabel_format(useOffset=False, style='plain')
     if origin_at_zero:
         axes.set_ylim(bottom=0)
         axes.set_xlim(left=0)
-    for step, x, y in zip(table['step'][start_index:], x_values, y_values[y_column]):
-        axes.annotate(step, (x, y), xytext=(0, 5), textcoords='offset points', size=7)
+    if step_labels:
+        add_step_labels(axes, x_values, y_values, steps[start_index:])
+
+
+def format_column_cells(values: Series) -> tuple[list[str], bool]:
+    # Formats values the same way python-tabulate would: ints with thousands separators, floats in the 'g' format with
+    # decimal points aligned and missing values as empty cells. Returns the cells and whether the column is numeric.
+    missing = values.isna().to_numpy()
+    kind = pandas.api.types.infer_dtype(values, skipna=True)
+    if missing.all() or kind not in {'integer', 'floating', 'mixed-integer-float'}:
+        # Ignore surrounding whitespace
+        return (['' if is_missing else str(value).strip() for value, is_missing in zip(values.tolist(), missing)], False)
+
+    if kind == 'integer':
+        return (['' if is_missing else f'{int(value):,}' for value, is_missing in zip(values.tolist(), missing)], True)
+
+    cells = ['' if is_missing else format(float(value), 'g') for value, is_missing in zip(values.tolist(), missing)]
+
+    def digits_after_point(cell):
+        point_position = cell.rfind('.')
+        if point_position < 0:
+            point_position = cell.rfind('e')
+        return len(cell) - point_position - 1 if point_position >= 0 else -1
+
+    decimal_digits = [digits_after_point(cell) for cell in cells]
+    max_decimal_digits = max(decimal_digits)
+    return (
+        [
+            cell + ' ' * (max_decimal_digits - digits) if cell != '' else ''
+            for cell, digits in zip(cells, decimal_digits)
+        ],
+        True,
+    )
+
 
+def format_table(table: DataFrame) -> str:
+    # Produces the same layout as python-tabulate's 'pipe' format but formats whole columns based on their type.
+    # tabulate determines the type of every cell separately, which gets very slow for big tables.
 
-def format_table(table: DataFrame, int_format_bug_workaround: bool = False) -> str:
     # Allow column names with dashes to wrap to keep columns narrower
     table = table.rename(columns={name: name.replace('_', ' ') for name in table.columns})
 
-    # astype('object') allows us to put the empty string even in columns that enforce a non-string dtype
-    prepared_table = table.astype('object').fillna('')
-    show_index = True
+    headers = ['' if table.index.name is None else str(table.index.name)] + [str(name) for name in table.columns]
+    formatted_columns = [format_column_cells(table.index.to_series())] + [
+        format_column_cells(table[name])
+        for name in table.columns
+    ]
 
-    if int_format_bug_workaround:
-        # FIXME: When the table contains no columns with dtype 'object', tabulate seems to treat 'int' columns as 'float'.
-        # This happens even when there are only 'int' columns in the table.
-        # Probably also related to https://github.com/astanin/python-tabulate/issues/18.
-        # As a workaround, manually flatten the table before printing.
-        prepared_table = [
-            {prepared_table.index.name: index} | row
-            for index, row in zip(prepared_table.index, prepared_table.to_dict('records'))
-        ]
-        show_index = False
+    widths = [
+        max([len(header) + 2] + [len(cell) for cell in cells])
+        for header, (cells, _numeric) in zip(headers, formatted_columns)
+    ]
+    justify_functions = [str.rjust if numeric else str.ljust for (_cells, numeric) in formatted_columns]
+
+    lines = [
+        '| ' + ' | '.join(justify(header, width) for header, width, justify in zip(headers, widths, justify_functions)) + ' |',
+        '|' + '|'.join(
+            '-' * (width + 1) + ':' if numeric else ':' + '-' * (width + 1)
+            for width, (_cells, numeric) in zip(widths, formatted_columns)
+        ) + '|',
+    ]
+    for row in zip(*(cells for (cells, _numeric) in formatted_columns)):
+        lines.append('| ' + ' | '.join(justify(cell, width) for cell, width, justify in zip(row, widths, justify_functions)) + ' |')
 
-    return tabulate(prepared_table, headers='keys', tablefmt='pipe', showindex=show_index, intfmt=',')
+    return '\n'.join(lines)
 
 
 def build_comparison_table(column_name: str, tables: list[DataFrame], table_names: list[str], shared_step_column: bool) -> DataFrame:
     assert len(tables) > 0
     assert len(tables) == len(table_names)
 
-    if shared_step_column:
-        comparison_table = tables[0][['step', 'step_name']]
-    else:
-        comparison_table = pandas.DataFrame(index=tables[0].index)
-
+    # Concatenating all the columns at once aligns the indexes in a single step rather than once per table
+    columns = [tables[0][['step', 'step_name']]] if shared_step_column else []
     for table, table_name in zip(tables, table_names):
         if not shared_step_column:
-            comparison_table[f'step {table_name}'] = table['step']
-
-        comparison_table = comparison_table.merge(
-            table[[column_name]].rename(columns={column_name: table_name}),
-            left_index=True,
-            right_index=True,
-            how='outer'
-        )
+            columns.append(table['step'].rename(f'step {table_name}'))
+        columns.append(table[column_name].rename(table_name))
+    comparison_table = pandas.concat(columns, axis=1, join='outer', sort=True)
 
     return comparison_table
 
 
-def build_summary_table(selected_columns: list[str], tables: list[DataFrame], report_names: list[str], value_set: str) -> DataFrame:
+def build_summary_tables(
+    selected_columns: list[str],
+    tables: list[DataFrame],
+    report_names: list[str],
+) -> tuple[DataFrame, DataFrame, DataFrame]:
     assert len(tables) == len(report_names)
     assert all(len(table) > 0 for table in tables)
     assert all('' not in table for table in tables)
-    assert value_set in ['before', 'after', 'min']
 
-    def summary_row(table, report_name, value_set):
-        if value_set == 'before':
-            row = table.iloc[[0]].reset_index(drop=True)
-        elif value_set == 'after':
-            row = table.iloc[[-1]].reset_index(drop=True)
-        elif value_set == 'min':
-            row = table.min(numeric_only=True).to_frame().T
+    # Select the columns only once per table and collect the values before the first step, after the last step
+    # and the minimum at the same time.
+    # NOTE: Not using agg('first')/agg('last') because they skip missing values.
+    before_rows = []
+    after_rows = []
+    min_rows = []
+    for table in tables:
+        selected_table = table[selected_columns]
+        before_rows.append(selected_table.iloc[[0]])
+        after_rows.append(selected_table.iloc[[-1]])
+        min_rows.append(selected_table.min(numeric_only=True).to_frame().T)
+
+    report_index = pandas.Index(report_names, name='')
+    return (
+        pandas.concat(before_rows).set_axis(report_index),
+        pandas.concat(after_rows).set_axis(report_index),
+        pandas.concat(min_rows).set_axis(report_index),
+    )
 
-        row[''] = report_name
-        return row.set_index('')
 
-    return pandas.concat([
-        summary_row(table[selected_columns], report_name, value_set)
-        for table, report_name in zip(tables, report_names)
-    ])
+def load_report(report_path: str) -> DataFrame:
+    if Path(report_path).suffix == '.jsonl':
+        # JSON Lines reports can be huge. Read them in chunks to keep only one chunk of raw JSON in memory at a time.
+        # NOTE: Types must be fixed up front. Otherwise pandas guesses them separately for each chunk and, e.g.,
+        # interprets big values in columns ending with '_time' as dates in chunks that do not contain step 0.
+        with pandas.read_json(
+            report_path,
+            lines=True,
+            chunksize=100_000,
+            dtype=REPORT_COLUMN_DTYPES,
+            convert_dates=False,
+            keep_default_dates=False,
+            precise_float=True,
+        ) as chunks:
+            table = pandas.concat(chunks).set_index('index')
+        table.index.name = None
+    else:
+        # Parse directly from mapped pages rather than reading the whole file into a bytes object first
+        with open(report_path, 'rb') as report_file, mmap.mmap(report_file.fileno(), 0, prot=mmap.PROT_READ) as report_buffer:
+            with memoryview(report_buffer) as report_view:
+                table = DataFrame(orjson.loads(report_view))
+        table.index = table.index.astype(int)
+
+    # Same as pandas.read_json(): use an integer type for columns that turned out to contain only whole numbers.
+    for column in table.select_dtypes('float').columns:
+        if table[column].notna().all() and (table[column] % 1 == 0).all():
+            table[column] = table[column].astype(int)
+
+    return table
 
 
 def simplify_report_names(report_names: list[str]):
@@ -140,16 +270,25 @@ def main(
     output_dir: str,
     document_title: str | None,
 ):
-    tables = [pandas.read_json(path) for path in report_paths]
+    tables = [load_report(path) for path in report_paths]
     if len(tables) == 0:
         print("No input files specified.")
         return
 
     for table in tables:
-        # NOTE: If there is even one float column, python-tabulate converts all int columns to float as well.
-        # The fix is available but not in the latest release yet, see: https://github.com/astanin/python-tabulate/issues/18.
-        # Just convert time columns to microseconds, both to avoid this and for consistency.
-        table['compilation_time'] = (table['compilation_time'] * 10**6).round().astype({'compilation_time': int})
+        # Convert time columns to integer microseconds for consistency with other time columns.
+        # Compilation time is missing only for prefixes whose compilation was skipped. Those never have bytecode.
+        missing_compilation_times = table['compilation_time'].isna()
+        require(
+            (~missing_compilation_times | table['bytecode_size'].isna()).all(),
+            "Compilation time is missing for some of the compiled steps.",
+        )
+        compilation_times = numpy.rint(table['compilation_time'].to_numpy() * 10**6)
+        if missing_compilation_times.any():
+            # Nullable integer type, to keep the missing values
+            table['compilation_time'] = pandas.array(compilation_times, dtype='Int64')
+        else:
+            table['compilation_time'] = compilation_times.astype(numpy.int64, copy=False)
         table.rename(columns={'duration_microsec': 'duration'}, inplace=True)
 
     require(len(report_name) == len(set(report_name)), "Report names are not unique.")
@@ -158,18 +297,40 @@ def main(
 
     simple_report_names = simplify_report_names(report_name)
 
+    # NOTE: Comparing plain arrays rather than Series also makes the missing step at index 0 (None) compare
+    # equal. pandas treats missing values as never equal.
+    steps = tables[0]['step'].to_numpy()
+    step_names = tables[0]['step_name'].to_numpy()
     tables_have_compatible_steps = True
     for i, other_table in enumerate(tables[1:]):
-        shared_indices = tables[0].index.intersection(other_table.index)
-        if (tables[0]['step'].loc[shared_indices] != other_table['step'].loc[shared_indices]).any():
+        shared_indices = numpy.intersect1d(tables[0].index, other_table.index, assume_unique=True)
+        positions = tables[0].index.get_indexer(shared_indices)
+        other_positions = other_table.index.get_indexer(shared_indices)
+        if not numpy.array_equal(steps[positions], other_table['step'].to_numpy()[other_positions]):
             tables_have_compatible_steps = False
             break
         require(
-            (tables[0]['step_name'].loc[shared_indices] == other_table['step_name'].loc[shared_indices]).all(),
+            numpy.array_equal(step_names[positions], other_table['step_name'].to_numpy()[other_positions]),
             f"Tables 0 and {i + 1} use different names for some of the same steps.",
         )
 
-    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    output_path = Path(output_dir)
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    # Columns present in the first report decide which plots and tables get generated.
+    available_columns = frozenset(tables[0].columns)
+
+    # Extract plotted columns once as plain arrays rather than going through pandas indexing in every plot.
+    # Values are converted to floats so that missing values in nullable integer columns become NaN.
+    plotted_columns = ['runtime_gas', 'bytecode_size', 'creation_gas', 'duration', 'optimization_time', 'compilation_time']
+    table_arrays = [
+        {'index': table.index.to_numpy(), 'step': table['step'].to_numpy()} | {
+            column: table[column].to_numpy(dtype='float64', na_value=numpy.nan)
+            for column in plotted_columns
+            if column in table.columns
+        }
+        for table in tables
+    ]
 
     selected_columns = [
         'runtime_gas',
@@ -182,18 +343,20 @@ def main(
     assert 'step' not in selected_columns
     assert 'step_name' not in selected_columns
 
-    document = f"## {document_title}\n\n" if document_title is not None else ''
+    # Accumulate the document in a buffer rather than by repeatedly concatenating a growing string
+    document = io.StringIO()
+    if document_title is not None:
+        document.write(f"## {document_title}\n\n")
 
     summary_columns = [c for c in selected_columns if c != 'duration']
 
-    document += f"\n\n### Summary\n\n"
+    document.write(f"\n\n### Summary\n\n")
 
     def add_summary_table(title, summary_table):
-        nonlocal document
-        formatted_table = format_table(summary_table, int_format_bug_workaround=True)
+        formatted_table = format_table(summary_table)
         if show_table:
             print(formatted_table)
-        document += f"#### {title}\n\n{formatted_table}\n\n"
+        document.write(f"#### {title}\n\n{formatted_table}\n\n")
 
     minimized_columns = [
         'runtime_gas',
@@ -202,20 +365,22 @@ def main(
     ]
     assert set(minimized_columns).issubset(set(selected_columns))
 
-    before_summary_table = build_summary_table(summary_columns, tables, simple_report_names, 'before')
-    after_summary_table  = build_summary_table(summary_columns, tables, simple_report_names, 'after')
-    min_summary_table    = build_summary_table(summary_columns, tables, simple_report_names, 'min')
+    (before_summary_table, after_summary_table, min_summary_table) = build_summary_tables(
+        summary_columns,
+        tables,
+        simple_report_names,
+    )
     add_summary_table("Unoptimized values", before_summary_table)
     add_summary_table("Final values", after_summary_table)
 
     diff_table = (
         (after_summary_table[minimized_columns] - before_summary_table[minimized_columns]) /
         before_summary_table[minimized_columns]
-    ).fillna(numpy.nan).replace([numpy.nan], [None]).applymap(lambda x: format_percent(x, fractional_digits=1))
+    ).apply(format_percent_series, fractional_digits=1)
     min_diff_table = (
         (min_summary_table[minimized_columns] - before_summary_table[minimized_columns]) /
         before_summary_table[minimized_columns]
-    ).fillna(numpy.nan).replace([numpy.nan], [None]).applymap(lambda x: format_percent(x, fractional_digits=1))
+    ).apply(format_percent_series, fractional_digits=1)
 
     combined_diff_table = diff_table.where(
         diff_table == min_diff_table,
@@ -223,77 +388,98 @@ def main(
     )
     add_summary_table("Final values vs unoptimized", combined_diff_table)
 
-    document += f"\n\n### Plots\n\n"
+    # NOTE: matplotlib is slow to import so don't load it until it's actually needed.
+    import matplotlib
+    if not show_plot:
+        # Plots only get saved to files so there's no point in initializing an interactive backend.
+        # Selecting it before pyplot is loaded also avoids importing any GUI toolkit.
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    document.write(f"\n\n### Plots\n\n")
 
     def add_plot_vs_index(plot_name, column, ylabel, title, style='line'):
-        nonlocal document
-        plt.figure(title)
-        for table in tables:
-            plot_column_with_step_labels(table, column, ylabel, title, style, origin_at_zero=(len(tables) == 1))
+        figure = plt.figure(title)
+        for arrays in table_arrays:
+            plot_column_with_step_labels(
+                arrays['index'],
+                arrays['step'],
+                arrays[column],
+                ylabel,
+                title,
+                style,
+                origin_at_zero=(len(tables) == 1),
+                step_labels=(show_plot or len(arrays['index']) <= STEP_LABEL_LIMIT),
+            )
         plt.legend(simple_report_names)
         plot_file_name = f'{name_prefix}{plot_name}.svg'
-        plt.savefig(Path(output_dir) / plot_file_name)
-        document += f"#### {title}\n\n![{title}]({plot_file_name})\n"
+        figure.savefig(output_path / plot_file_name)
+        if not show_plot:
+            # Release the figure and all its artists as soon as it's saved. It won't be needed again.
+            plt.close(figure)
+        document.write(f"#### {title}\n\n![{title}]({plot_file_name})\n")
 
     def add_plot_vs_time(plot_name, y_column, ylabel, title):
-        nonlocal document
-        plt.figure(title)
-        for table in tables:
+        figure = plt.figure(title)
+        for arrays in table_arrays:
             plot_xy_with_step_labels(
-                table,
-                'optimization_time',
-                y_column,
+                arrays['optimization_time'],
+                arrays[y_column],
+                arrays['step'],
                 'time (microseconds)',
                 ylabel,
                 title,
                 start_index=1,
                 origin_at_zero=(len(tables) == 1),
+                step_labels=(show_plot or len(arrays['index']) <= STEP_LABEL_LIMIT),
             )
         plt.legend(simple_report_names)
         plot_file_name = f'{name_prefix}{plot_name}.svg'
-        plt.savefig(Path(output_dir) / plot_file_name)
-        document += f"#### {title}\n\n![{title}]({plot_file_name})\n"
+        figure.savefig(output_path / plot_file_name)
+        if not show_plot:
+            plt.close(figure)
+        document.write(f"#### {title}\n\n![{title}]({plot_file_name})\n")
 
     add_plot_vs_index('runtime-gas', 'runtime_gas', 'gas', 'Test execution cost after each step')
-    if 'optimization_time' in tables[0].columns:
+    if 'optimization_time' in available_columns:
         add_plot_vs_time('runtime-gas-vs-optimization-time', 'runtime_gas', 'gas', 'Test execution cost vs optimization time')
 
     add_plot_vs_index('bytecode-size', 'bytecode_size', 'size (bytes)', 'Bytecode size after each step')
-    if 'optimization_time' in tables[0].columns:
+    if 'optimization_time' in available_columns:
         add_plot_vs_time('bytecode-size-vs-optimization-time', 'bytecode_size', 'size (bytes)', 'Bytecode size vs optimization time')
 
     add_plot_vs_index('creation-gas', 'creation_gas', 'gas', 'Contract deployment cost after each step')
-    if 'optimization_time' in tables[0].columns:
+    if 'optimization_time' in available_columns:
         add_plot_vs_time('creation-gas-vs-optimization-time', 'creation_gas', 'gas', 'Contract deployment cost vs optimization time')
 
-    if 'optimization_time' in tables[0].columns and 'duration' in tables[0].columns:
+    if 'optimization_time' in available_columns and 'duration' in available_columns:
         duration_plot_style = 'bar' if len(tables) == 1 else 'line'
         add_plot_vs_index('step-duration', 'duration', 'time (microseconds)', 'Duration of each step', style=duration_plot_style)
         add_plot_vs_index('optimization-time', 'optimization_time', 'time (microseconds)', 'Cumulative optimization time after each step')
 
     add_plot_vs_index('compilation-time', 'compilation_time', 'time (microseconds)', 'Compilation time with a prefix ending at this step')
 
-    document += f"\n\n### Tables\n\n"
+    document.write(f"\n\n### Tables\n\n")
 
     if len(tables) == 1:
         formatted_table = format_table(tables[0][['step', 'step_name'] + selected_columns])
         if show_table:
             print(formatted_table)
         if simple_report_names[0] != '':
-            document += f"#### {simple_report_names[0]}\n\n"
-        document += formatted_table + '\n\n'
+            document.write(f"#### {simple_report_names[0]}\n\n")
+        document.write(formatted_table + '\n\n')
     else:
         for column in selected_columns:
-            if column in tables[0].columns:
-                document += f"#### {column}\n\n"
+            if column in available_columns:
+                document.write(f"#### {column}\n\n")
                 formatted_table = format_table(build_comparison_table(column, tables, simple_report_names, shared_step_column=tables_have_compatible_steps))
                 if show_table:
                     print(f"\n{column}\n")
                     print(formatted_table)
-                document += formatted_table + '\n\n'
+                document.write(formatted_table + '\n\n')
 
-    with open(Path(output_dir) / f'{name_prefix}report.md', 'w') as document_file:
-        document_file.write(document)
+    with open(output_path / f'{name_prefix}report.md', 'w') as document_file:
+        document_file.write(document.getvalue())
 
     if show_plot:
         plt.show()